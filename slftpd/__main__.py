@@ -15,11 +15,23 @@ logger.addHandler(ch)
 parser = argparse.ArgumentParser(description='FTP server by Gerald.')
 parser.add_argument('-p', '--port', default=8021, help='the port for the server to bind')
 parser.add_argument('-H', '--homedir', default='.', help='the home directory of anonymous user')
+parser.add_argument('--loop', default='asyncio', choices=('asyncio', 'uvloop', 'auto'), help='the event loop backend, auto for uvloop if installed')
+parser.add_argument('--threads', type=int, default=1, help='the number of threads each running an event loop on the same port')
+parser.add_argument('--lag-threshold', type=float, default=0, help='log callbacks blocking the event loop longer than this many seconds')
+parser.add_argument('--archive', action='store_true', help='allow retrieving directories as archives, e.g. `RETR dir.tar` or `RETR dir.tar.gz`')
+parser.add_argument('--trace', help='record an anonymized trace of all sessions to this file')
+parser.add_argument('--profile-dir', default='.', help='the directory to write profile reports to, send SIGUSR1 to start profiling')
 args = parser.parse_args()
 
 logger.info('FTP Server v%s/%s %s - by Gerald'
         % (__version__, platform.python_implementation(), platform.python_version()))
 config = Config()
 config.port = args.port
+config.loop = args.loop
+config.threads = args.threads
+config.lag_threshold = args.lag_threshold
+config.profile_dir = args.profile_dir
+config.trace_file = args.trace
+config.archive = args.archive
 config.add_anonymous_user(homedir=args.homedir)
 serve(config)
@@ -0,0 +1,61 @@
+'''
+Tar archives generated while they are sent.
+'''
+import tarfile, zlib, stat
+
+class TarProducer:
+    '''Produce a tar archive (optionally gzipped) chunk by chunk.
+
+    - members MUST be an iterable of (arcname, realpath, entry), where entry
+      is a `fsindex.Entry` and realpath is None for directories.
+
+    Sizes in headers are taken from `entry`, a file that changes while it
+    is being sent is truncated or padded with zeros to that size.
+    '''
+    def __init__(self, members, bufsize, compress=False):
+        self.members = members
+        self.bufsize = bufsize
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+        self.offset = 0
+
+    def __iter__(self):
+        for data in self.generate():
+            self.offset += len(data)
+            if self.compressor is not None:
+                data = self.compressor.compress(data)
+            if data:
+                yield data
+        tail = bytes(-self.offset % tarfile.RECORDSIZE)
+        if self.compressor is not None:
+            tail = self.compressor.compress(tail) + self.compressor.flush()
+        if tail:
+            yield tail
+
+    def generate(self):
+        for arcname, realpath, entry in self.members:
+            info = tarfile.TarInfo(arcname)
+            info.mode = stat.S_IMODE(entry.mode)
+            info.mtime = entry.mtime
+            if realpath is None:
+                info.type = tarfile.DIRTYPE
+                yield info.tobuf(tarfile.PAX_FORMAT)
+                continue
+            try:
+                fp = open(realpath, 'rb')
+            except OSError:
+                continue
+            with fp:
+                info.size = entry.size
+                yield info.tobuf(tarfile.PAX_FORMAT)
+                remaining = entry.size
+                while remaining > 0:
+                    data = fp.read(min(self.bufsize, remaining))
+                    if not data:
+                        data = bytes(min(self.bufsize, remaining))
+                    remaining -= len(data)
+                    yield data
+            padding = -entry.size % tarfile.BLOCKSIZE
+            if padding:
+                yield bytes(padding)
+        # End of archive
+        yield bytes(tarfile.BLOCKSIZE * 2)
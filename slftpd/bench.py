@@ -0,0 +1,137 @@
+'''
+Benchmarks against a local server.
+
+Usage:
+
+    python3 -m slftpd.bench smallfiles -n 1000 -s 1024
+    python3 -m slftpd.bench transfer -s 64
+    python3 -m slftpd.bench backends -c 20 -n 200
+'''
+import asyncio, argparse, logging, tempfile, time, os, shutil
+from .client import FTPClient
+from .server import start_local_server
+from .log import logger
+
+async def transfer_files(addr, names, mode, upload=False, size=0):
+    '''Transfer files one after another in one session, return the elapsed time.'''
+    client = FTPClient()
+    await client.connect(*addr)
+    await client.login()
+    await client.command('TYPE I')
+    await client.command('MODE ' + mode)
+    start = time.perf_counter()
+    for name in names:
+        if client.data is None:
+            await client.pasv()
+        if upload:
+            code, message, _ = await client.transfer('STOR ' + name, size)
+        else:
+            code, message, _ = await client.transfer('RETR ' + name)
+        if code >= 400:
+            raise RuntimeError(message)
+    elapsed = time.perf_counter() - start
+    client.close()
+    return elapsed
+
+async def run_clients(addr, names, mode, clients):
+    await asyncio.gather(*(transfer_files(addr, names, mode) for _ in range(clients)))
+
+def bench_smallfiles(args):
+    root = tempfile.mkdtemp(prefix='slftpd-bench-')
+    try:
+        names = ['file%05d' % i for i in range(args.number)]
+        data = os.urandom(args.size)
+        for name in names:
+            with open(os.path.join(root, name), 'wb') as fp:
+                fp.write(data)
+        addr = start_local_server(root)
+        loop = asyncio.new_event_loop()
+        print('%d files of %d bytes' % (args.number, args.size))
+        for mode in ('S', 'B'):
+            for upload in (False, True):
+                elapsed = loop.run_until_complete(
+                        transfer_files(addr, names, mode, upload, args.size))
+                print('MODE %s %s: %.2fs, %.1f files/s' % (
+                    mode, 'STOR' if upload else 'RETR', elapsed, args.number / elapsed))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def bench_transfer(args):
+    root = tempfile.mkdtemp(prefix='slftpd-bench-')
+    try:
+        size = args.size * 0x100000
+        with open(os.path.join(root, 'large'), 'wb') as fp:
+            for _ in range(args.size):
+                fp.write(os.urandom(0x100000))
+        addr = start_local_server(root)
+        loop = asyncio.new_event_loop()
+        print('%d transfers of %d MiB' % (args.number, args.size))
+        for upload in (False, True):
+            elapsed = loop.run_until_complete(transfer_files(
+                addr, ['large'] * args.number, 'S', upload, size))
+            print('%s: %.2fs, %.1f MiB/s' % (
+                'STOR' if upload else 'RETR', elapsed, args.size * args.number / elapsed))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def bench_backends(args):
+    backends = ['asyncio']
+    try:
+        import uvloop
+    except ImportError:
+        print('uvloop is not installed, skipped')
+    else:
+        backends.append('uvloop')
+    root = tempfile.mkdtemp(prefix='slftpd-bench-')
+    try:
+        names = ['file%02d' % i for i in range(10)]
+        data = os.urandom(args.size)
+        for name in names:
+            with open(os.path.join(root, name), 'wb') as fp:
+                fp.write(data)
+        names = names * (args.number // len(names))
+        loop = asyncio.new_event_loop()
+        print('%d clients, each retrieving %d files of %d bytes in MODE %s' % (
+            args.clients, len(names), args.size, args.mode))
+        for backend in backends:
+            for threads in sorted(set((1, args.threads))):
+                addr = start_local_server(root, backend=backend, threads=threads)
+                start = time.perf_counter()
+                loop.run_until_complete(run_clients(addr, names, args.mode, args.clients))
+                elapsed = time.perf_counter() - start
+                print('%s, %d thread(s): %.2fs, %.1f files/s' % (
+                    backend, threads, elapsed, args.clients * len(names) / elapsed))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of slftpd.')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+    parser_smallfiles = subparsers.add_parser('smallfiles',
+            help='transfer many small files in stream and block mode')
+    parser_smallfiles.add_argument('-n', '--number', type=int, default=1000, help='number of files')
+    parser_smallfiles.add_argument('-s', '--size', type=int, default=1024, help='size of each file')
+    parser_smallfiles.set_defaults(func=bench_smallfiles)
+    parser_transfer = subparsers.add_parser('transfer',
+            help='transfer a large file')
+    parser_transfer.add_argument('-n', '--number', type=int, default=3, help='number of transfers')
+    parser_transfer.add_argument('-s', '--size', type=int, default=64, help='size of the file in MiB')
+    parser_transfer.set_defaults(func=bench_transfer)
+    parser_backends = subparsers.add_parser('backends',
+            help='compare event loop backends and threads with concurrent clients')
+    parser_backends.add_argument('-c', '--clients', type=int, default=20, help='number of concurrent clients')
+    parser_backends.add_argument('-n', '--number', type=int, default=200, help='number of files per client')
+    parser_backends.add_argument('-s', '--size', type=int, default=1024, help='size of each file')
+    parser_backends.add_argument('-t', '--threads', type=int, default=min(4, os.cpu_count() or 1),
+            help='number of server threads to compare with one thread')
+    parser_backends.add_argument('-m', '--mode', default='B', choices=('S', 'B'), help='transfer mode')
+    parser_backends.set_defaults(func=bench_backends)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.WARNING)
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+'''
+Minimal asynchronous FTP client, used to replay traces and run benchmarks.
+'''
+import asyncio, re, struct
+
+BLOCK_HEADER = struct.Struct('>BH')
+BLOCK_EOF = 0x40
+BLOCK_SIZE = 0xffff
+
+class FTPError(Exception):
+    pass
+
+class FTPClient:
+    upload_commands = frozenset(('STOR', 'APPE', 'STOU'))
+
+    def __init__(self, bufsize=0x10000):
+        self.bufsize = bufsize
+        self.data_addr = None
+        self.data = None
+        self.block = False
+
+    async def connect(self, host, port):
+        self.host = host
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        return await self.response()
+
+    def close(self):
+        self.close_data()
+        self.writer.close()
+
+    def close_data(self):
+        if self.data is not None:
+            self.data[1].close()
+            self.data = None
+
+    async def response(self):
+        '''Read a (possibly multi-line) reply, return (code, message).'''
+        line = await self.reader.readline()
+        if not line:
+            raise FTPError('Connection closed')
+        line = line.decode('utf-8', 'replace').rstrip('\r\n')
+        lines = [line]
+        if line[3:4] == '-':
+            end = line[:3] + ' '
+            while not line.startswith(end):
+                line = (await self.reader.readline()).decode('utf-8', 'replace').rstrip('\r\n')
+                if not line:
+                    raise FTPError('Connection closed')
+                lines.append(line)
+        return int(lines[0][:3]), '\n'.join(lines)
+
+    async def command(self, line):
+        '''Run a command, return (code, message) of its final reply.
+        Data sent by the server on a preliminary reply is discarded.'''
+        code, message, _ = await self.transfer(line)
+        return code, message
+
+    async def send_command(self, line):
+        '''Send a command and read one reply.'''
+        self.writer.write(line.encode('utf-8') + b'\r\n')
+        code, message = await self.response()
+        cmd, _, args = line.partition(' ')
+        if cmd.upper() == 'MODE' and code == 200:
+            self.block = args.strip().upper() == 'B'
+            self.close_data()
+        return code, message
+
+    async def login(self, user='anonymous', pwd=''):
+        code, message = await self.command('USER ' + user)
+        if code == 331:
+            code, message = await self.command('PASS ' + pwd)
+        if code != 230:
+            raise FTPError(message)
+
+    async def pasv(self):
+        code, message = await self.send_command('PASV')
+        if code != 227:
+            raise FTPError(message)
+        numbers = re.search(r'(\d+),(\d+),(\d+),(\d+),(\d+),(\d+)', message).groups()
+        self.data_addr = '.'.join(numbers[:4]), (int(numbers[4]) << 8) + int(numbers[5])
+        self.close_data()
+        return code, message
+
+    async def transfer(self, line, size=0, fileobj=None):
+        '''Run a command, transferring data if the server answers with a
+        preliminary reply. The data connection is opened to the address of
+        the last PASV and kept open in block mode.
+
+        Uploads send `size` bytes of padding, downloads are written to
+        `fileobj` if given. Return (code, message, bytes transferred).
+        '''
+        cmd = line.partition(' ')[0].upper()
+        code, message = await self.send_command(line)
+        if code not in (125, 150):
+            return code, message, 0
+        try:
+            if self.data is None:
+                if self.data_addr is None:
+                    raise FTPError('No data connection for %s: %s' % (cmd, message))
+                addr, self.data_addr = self.data_addr, None
+                self.data = await asyncio.open_connection(*addr)
+            reader, writer = self.data
+            if cmd in self.upload_commands:
+                transferred = await self.send(writer, size)
+            else:
+                transferred = await self.receive(reader, fileobj)
+        finally:
+            if not self.block:
+                self.close_data()
+        code, message = await self.response()
+        if code >= 400:
+            self.close_data()
+        return code, message, transferred
+
+    async def send(self, writer, size):
+        chunk = b'\0' * min(self.bufsize, BLOCK_SIZE)
+        sent = 0
+        while sent < size:
+            data = chunk[:size - sent]
+            sent += len(data)
+            if self.block:
+                data = BLOCK_HEADER.pack(0, len(data)) + data
+            writer.write(data)
+            await writer.drain()
+        if self.block:
+            writer.write(BLOCK_HEADER.pack(BLOCK_EOF, 0))
+            await writer.drain()
+        else:
+            writer.close()
+        return sent
+
+    async def receive(self, reader, fileobj=None):
+        received = 0
+        while True:
+            if self.block:
+                descriptor, count = BLOCK_HEADER.unpack(
+                        await reader.readexactly(BLOCK_HEADER.size))
+                data = await reader.readexactly(count)
+            else:
+                data = await reader.read(self.bufsize)
+                if not data: break
+            received += len(data)
+            if fileobj is not None:
+                fileobj.write(data)
+            if self.block and descriptor & BLOCK_EOF: break
+        return received
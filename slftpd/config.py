@@ -1,5 +1,11 @@
-import os, asyncio
+import os, asyncio, socket, threading
+from collections import deque
 from .log import logger
+from .timer import TimerWheel
+from .monitor import Profiler
+from .quota import UsageIndex
+from .trace import TraceWriter
+from .fsindex import FSIndex
 
 def _normpath(path):
     return os.path.normpath(path).replace('\\', '/')
@@ -19,6 +25,7 @@ class DirRule:
         - m for making directories on server.
       - max_down {Integer} Number of bytes
       - max_up {Integer} Number of bytes
+      - quota {Integer} Number of bytes that can be stored in `dest`
     '''
     def __init__(self, src, dest, attrs=()):
         if not src.endswith('/'): src += '/'
@@ -30,9 +37,11 @@ class DirRule:
 class FTPUser:
     def __init__(self, name='anonymous', pwd='',
             homedir='.', attrs=(),
-            loginmsg=None, max_connection=1):
+            loginmsg=None, max_connection=1, admin=False, quota=0):
         self.name = name
         self.pwd = pwd
+        self.admin = admin
+        self.quota = quota
         self.homedir = self.normpath(homedir)
         self.loginmsg = loginmsg
         self.max_connection = max_connection
@@ -48,16 +57,54 @@ class FTPUser:
         self.rules.append(rule)
 
     def apply_rules(self, path):
+        '''Return the real path and attributes of `path`.
+
+        A quota only applies to paths stored under its rule's `dest`:
+
+        >>> user = FTPUser(homedir='/srv/ftp', attrs=(('quota', 1000),))
+        >>> user.add_rule('/ext', '/mnt/ext')
+        >>> user.apply_rules('/ext/file')[1].get('quota')
+        >>> user.add_rule('/sub', '/srv/ftp/sub')
+        >>> user.apply_rules('/sub/file')[1]['quota_root']
+        '/srv/ftp/'
+        '''
         context = {}
         realpath = None
         for rule in self.rules:
-            if path.startswith(rule.src):
-                context.update(rule.attrs)
+            if (path + '/').startswith(rule.src):
+                attrs = dict(rule.attrs)
+                context.update(attrs)
+                if attrs.get('quota'):
+                    context['quota_root'] = rule.dest
+                elif 'quota_root' in context and not rule.dest.startswith(context['quota_root']):
+                    # Mounted outside of the quota root, writes would not be counted
+                    del context['quota'], context['quota_root']
                 realpath = os.path.join(rule.dest, os.path.relpath(path, rule.src))
         return realpath, context
 
+    @property
+    def roots(self):
+        '''Real directories of the rules that are not nested in each other.'''
+        dests = set(rule.dest for rule in self.rules)
+        return [dest for dest in dests
+                if not any(dest != other and dest.startswith(other) for other in dests)]
+
 class Config:
+    # Initial and minimum chunk sizes, chunks grow up to buf_max
+    # with the throughput of each transfer.
     buf_in = buf_out = 0x1000
+    buf_max = 0x40000
+    chunk_time = 0.02
+    # (level, option, value) for sockets of each channel.
+    # Setting SO_SNDBUF/SO_RCVBUF disables buffer autotuning on Linux.
+    socket_options = {
+        'control': (
+            (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        ),
+        'data': (
+            (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        ),
+    }
     encoding = 'utf-8'
     host = '0.0.0.0'
     port = 21
@@ -65,7 +112,25 @@ class Config:
     max_user_connection = 1
     control_timeout = 120
     data_timeout = 10
+    timer_resolution = 1
+    lag_threshold = 0
+    profile_dir = '.'
+    profile_duration = 30
+    # Longest duration that can be requested with SITE PROFILE
+    profile_max_duration = 300
+    quota_snapshot = None
+    quota_reconcile = 0
+    trace_file = None
+    archive = False
+    # Event loop backend: asyncio, uvloop or auto
+    loop = 'asyncio'
+    # Number of threads, each running an event loop
+    threads = 1
     ports = None
+    profiler = None
+    usage = None
+    tracer = None
+    fsindex = None
     default_attrs = (
         ('permission', 'elr'),
         ('max_down', 0),
@@ -75,14 +140,33 @@ class Config:
     def __init__(self):
         self.connections = {None: 0}
         self.users = {}
+        # Shared state may be accessed by event loops in several threads
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        # (loop, future) of handlers waiting for a free port
+        self.port_waiters = deque()
 
     def set_ports(self, ports_start=8030, ports_end=8040):
-        if self.ports is not None:
-            logger.warn('Ports already initialized!')
-            return
-        self.ports = asyncio.Queue()
-        for i in range(ports_start, ports_end):
-            self.ports.put_nowait(i)
+        with self.lock:
+            if self.ports is not None:
+                logger.warn('Ports already initialized!')
+                return
+            self.ports = deque(range(ports_start, ports_end))
+
+    def open_connection(self, ip):
+        '''Count a new connection, return the number of connections from
+        `ip` and the total number of connections.'''
+        with self.lock:
+            n = self.connections[ip] = self.connections.get(ip, 0) + 1
+            self.connections[None] += 1
+            return n, self.connections[None]
+
+    def close_connection(self, ip):
+        with self.lock:
+            self.connections[None] -= 1
+            self.connections[ip] -= 1
+            if not self.connections[ip]:
+                del self.connections[ip]
 
     def add_user(self, name, **kw):
         kw.setdefault('attrs', self.default_attrs)
@@ -97,12 +181,76 @@ class Config:
         kw.setdefault('loginmsg', 'User ANONYMOUS okay, use email as password.')
         return self.add_user('anonymous', **kw)
 
-    def get_port(self):
+    async def get_port(self):
         if self.ports is None: self.set_ports()
-        return self.ports.get()
+        loop = asyncio.get_event_loop()
+        while True:
+            with self.lock:
+                if self.ports:
+                    return self.ports.popleft()
+                waiter = loop.create_future()
+                self.port_waiters.append((loop, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if not waiter.cancelled():
+                    # Woken but cancelled before taking the port
+                    self.wake_port_waiter()
+                raise
+
+    def get_timer(self):
+        '''Return the timer wheel of the event loop in current thread.'''
+        timer = getattr(self.local, 'timer', None)
+        if timer is None:
+            timer = self.local.timer = TimerWheel(self.timer_resolution)
+        return timer
+
+    def get_profiler(self):
+        if self.profiler is None:
+            with self.lock:
+                if self.profiler is None:
+                    self.profiler = Profiler(self.profile_dir)
+        return self.profiler
+
+    def get_usage(self):
+        if self.usage is None:
+            with self.lock:
+                if self.usage is None:
+                    self.usage = UsageIndex(self.quota_snapshot)
+        return self.usage
+
+    def get_tracer(self):
+        if self.tracer is None and self.trace_file:
+            with self.lock:
+                if self.tracer is None:
+                    self.tracer = TraceWriter(self.trace_file)
+        return self.tracer
+
+    def get_fsindex(self):
+        if self.fsindex is None:
+            with self.lock:
+                if self.fsindex is None:
+                    self.fsindex = FSIndex()
+        return self.fsindex
 
     def put_port(self, port):
-        self.ports.put_nowait(port)
+        with self.lock:
+            self.ports.append(port)
+            self.wake_port_waiter()
+
+    def wake_port_waiter(self):
+        '''Wake the first handler waiting for a port, in its own loop.'''
+        with self.lock:
+            if self.port_waiters:
+                loop, waiter = self.port_waiters.popleft()
+                loop.call_soon_threadsafe(self.set_port_waiter, waiter)
+
+    def set_port_waiter(self, waiter):
+        if not waiter.done():
+            waiter.set_result(None)
+        elif self.ports:
+            # The waiter is cancelled, pass the port on to the next one
+            self.wake_port_waiter()
 
     def normpath(self, path):
         return _normpath(path)
@@ -0,0 +1,193 @@
+'''
+In-memory index of directory entries.
+
+Directories are scanned with `os.scandir` when they are first listed and
+kept until they change. Changes are picked up from inotify on Linux and
+from the server's own write commands. Without inotify, entries are not
+cached and each listing is a fresh scan.
+'''
+import os, errno, stat, struct, asyncio, threading, ctypes, ctypes.util
+from collections import namedtuple
+from .log import logger
+
+Entry = namedtuple('Entry', 'name mode size mtime link')
+
+def scandir(path):
+    '''Return a dict of the entries in a directory.'''
+    entries = {}
+    with os.scandir(path) as it:
+        for item in it:
+            try:
+                st = item.stat()
+                link = item.is_symlink()
+            except OSError:
+                continue
+            entries[item.name] = Entry(item.name, st.st_mode, st.st_size, st.st_mtime, link)
+    return entries
+
+def is_dir(entry):
+    return stat.S_ISDIR(entry.mode)
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+EVENT = struct.Struct('iIII')
+
+class Inotify:
+    '''Watch directories with inotify, calling `callback(path, mask)` on changes.
+
+    Watches belong to inodes, a directory reached by several paths (e.g.
+    bind mounts) has one watch and a callback for each of the paths.
+    '''
+    mask = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+            IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+    def __init__(self, libc, fd, callback, loop):
+        self.libc = libc
+        self.fd = fd
+        self.callback = callback
+        self.watches = {}
+        self.paths = {}
+        self.exhausted = False
+        loop.add_reader(fd, self.read)
+
+    @classmethod
+    def create(cls, callback, loop=None):
+        '''Return an `Inotify` instance, or None if inotify is not available.'''
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        return cls(libc, fd, callback, loop)
+
+    def watch(self, path):
+        if self.exhausted: return False
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                # Stop trying instead of failing on each listing
+                self.exhausted = True
+                logger.warning('Inotify watches are exhausted, new directories will not be cached, '
+                        'consider raising fs.inotify.max_user_watches')
+            else:
+                logger.debug('Failed watching %s: %s', path, os.strerror(error))
+            return False
+        self.watches.setdefault(wd, set()).add(path)
+        self.paths[path] = wd
+        return True
+
+    def unwatch(self, path):
+        wd = self.paths.pop(path, None)
+        paths = self.watches.get(wd)
+        if paths is None: return
+        paths.discard(path)
+        if not paths:
+            del self.watches[wd]
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        try:
+            data = os.read(self.fd, 0x10000)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                self.callback(None, mask)
+                continue
+            paths = self.watches.get(wd)
+            if paths is None: continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                for path in paths:
+                    if self.paths.get(path) == wd:
+                        del self.paths[path]
+            for path in list(paths):
+                self.callback(path, mask)
+
+class FSIndex:
+    def __init__(self, loop=None):
+        self.dirs = {}
+        # path => [number of scans, generation] of directories being scanned,
+        # a scan is not cached if the directory changes in the meantime
+        self.scans = {}
+        # Event loops in other threads may share the index
+        self.lock = threading.Lock()
+        self.inotify = Inotify.create(self.on_event, loop)
+        if self.inotify is None:
+            logger.info('inotify is not available, directory listings will not be cached')
+
+    def listdir(self, path):
+        '''Return a dict of name => Entry for the directory at `path`.'''
+        # Symlinks and relative paths share the entry of the real directory
+        path = os.path.realpath(path)
+        entries = self.dirs.get(path)
+        if entries is None:
+            with self.lock:
+                # Watch before scanning so that no change is missed
+                watched = self.inotify is not None and self.inotify.watch(path)
+                scan = self.scans.setdefault(path, [0, 0])
+                scan[0] += 1
+                generation = scan[1]
+            try:
+                entries = scandir(path)
+            finally:
+                with self.lock:
+                    scan[0] -= 1
+                    if not scan[0]:
+                        del self.scans[path]
+            if watched and scan[1] == generation:
+                with self.lock:
+                    self.dirs[path] = entries
+        return entries
+
+    def changed(self, path):
+        '''Called after `path` is created, modified or removed.'''
+        path = os.path.normpath(path)
+        path = os.path.join(os.path.realpath(os.path.dirname(path)), os.path.basename(path))
+        with self.lock:
+            self.invalidate(os.path.dirname(path))
+            if path in self.dirs or path in self.scans:
+                self.discard_tree(path)
+
+    def invalidate(self, path):
+        self.dirs.pop(path, None)
+        scan = self.scans.get(path)
+        if scan is not None:
+            scan[1] += 1
+
+    def discard_tree(self, path):
+        prefix = path + os.sep
+        for key in [key for key in self.scans if key == path or key.startswith(prefix)]:
+            self.invalidate(key)
+        for key in [key for key in self.dirs if key == path or key.startswith(prefix)]:
+            del self.dirs[key]
+            if self.inotify is not None:
+                self.inotify.unwatch(key)
+
+    def on_event(self, path, mask):
+        with self.lock:
+            if path is None:
+                self.dirs.clear()
+                for scan in self.scans.values():
+                    scan[1] += 1
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                self.discard_tree(path)
+            else:
+                self.invalidate(path)
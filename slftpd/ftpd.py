@@ -2,11 +2,27 @@
 FTP Server v2
 RFC 959, 2389
 '''
-import asyncio, traceback, time, os, socket, stat
+import asyncio, traceback, time, os, socket, stat, posixpath, fnmatch, struct, re
 from . import __version__
 from .log import logger
+from .quota import QuotaExceeded, Reservation, path_usage
+from .fsindex import Entry, is_dir
+from .archive import TarProducer
+from .tuning import ChunkSizer, set_socket_options
 SERVER_NAME = 'SLFTPD/' + __version__
 
+# MODE B, RFC 959 section 3.4.2
+BLOCK_HEADER = struct.Struct('>BH')
+BLOCK_EOF = 0x40
+BLOCK_RESTART = 0x10
+BLOCK_SIZE = 0xffff
+
+BARE_LF = re.compile(br'(?<!\r)\n')
+
+def parse_time(value):
+    '''Parse time in the format of YYYYMMDDHHMMSS.'''
+    return time.mktime(time.strptime(value, '%Y%m%d%H%M%S'))
+
 def time_string(timestamp):
     time_obj = time.localtime(timestamp)
     now = time.localtime()
@@ -16,32 +32,58 @@ def time_string(timestamp):
         return time.strftime('%b %d %Y', time_obj)
 
 class FileProducer:
+    '''Read a file in chunks.
+
+    In binary mode, chunks are memoryviews of a buffer that is reused for
+    the next chunk unless `release` is called. In ASCII mode, bare LFs are
+    converted to CRLF. The transporter may change `bufsize` between chunks.
+    '''
     def __init__(self, path, type, bufsize, offset=0):
-        mode = 'r'
-        if type == 'i': mode += 'b'
+        self.ascii = type == 'a'
+        # Whether the last ASCII chunk ended with CR
+        self.cr = False
         self.bufsize = bufsize
-        self.fp = open(path, mode)
+        self.buffer = None
+        self.fp = open(path, 'rb')
         if offset: self.fp.seek(offset)
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        data = self.fp.read(self.bufsize)
+        if self.ascii:
+            data = self.fp.read(self.bufsize)
+            if self.cr and data.startswith(b'\n'):
+                data = b'\n' + BARE_LF.sub(b'\r\n', data[1:])
+            else:
+                data = BARE_LF.sub(b'\r\n', data)
+            self.cr = data.endswith(b'\r')
+        else:
+            if self.buffer is None or len(self.buffer) < self.bufsize:
+                self.buffer = bytearray(self.bufsize)
+            view = memoryview(self.buffer)
+            data = view[:self.fp.readinto(view[:self.bufsize])]
         if data:
             return data
         else:
             self.fp.close()
             raise StopIteration
 
+    def release(self):
+        '''Read the next chunk into a new buffer as the last one is still in use.'''
+        self.buffer = None
+
 class Transporter:
     reader = None
     writer = None
     def __init__(self, config, context):
         self.config = config
         self.context = context
+        self.mode = 's'
         self.bytes_sent = 0
         self.bytes_received = 0
+        self.timed_out = False
+        self.eof = False
         self.connected = asyncio.Future()
 
     def close(self):
@@ -49,59 +91,153 @@ class Transporter:
         if self.writer:
             self.writer.close()
 
+    @property
+    def closed(self):
+        return self.writer is not None and (
+                self.writer.is_closing() or self.reader.at_eof())
+
+    def write(self, chunk):
+        if self.mode == 'b':
+            for i in range(0, len(chunk), BLOCK_SIZE):
+                block = chunk[i:i + BLOCK_SIZE]
+                self.writer.write(BLOCK_HEADER.pack(0, len(block)) + block)
+        else:
+            self.writer.write(chunk)
+
+    async def read(self, size):
+        '''Read a chunk, return empty bytes at the end of the transfer.'''
+        if self.mode != 'b':
+            return await self.reader.read(size)
+        while not self.eof:
+            descriptor, count = BLOCK_HEADER.unpack(
+                    await self.reader.readexactly(BLOCK_HEADER.size))
+            data = await self.reader.readexactly(count)
+            if descriptor & BLOCK_EOF:
+                self.eof = True
+            # Restart markers are not supported
+            if data and not descriptor & BLOCK_RESTART:
+                return data
+        return b''
+
+    def start_timeout(self):
+        return self.config.get_timer().add(self.config.data_timeout, self.on_timeout)
+
+    def on_timeout(self):
+        self.timed_out = True
+        if self.writer:
+            self.writer.transport.abort()
+
+    def get_sizer(self, bufsize, rate):
+        return ChunkSizer(bufsize, self.config.buf_max, rate, self.config.chunk_time)
+
     async def push(self, data):
+        '''Send chunks of `data`.
+
+        If `data` has a `bufsize` attribute, it is updated with the chunk
+        size adapted to the throughput. If it has a `release` method, it is
+        called when the transport may still reference the last chunk.
+        '''
         max_down = self.context.get('max_down')
-        delta = self.config.buf_out / max_down if max_down else 0
+        sizer = self.get_sizer(self.config.buf_out, max_down)
+        adaptive = hasattr(data, 'bufsize')
+        if adaptive: data.bufsize = sizer.size
+        release = getattr(data, 'release', None)
+        transport = self.writer.transport
         loop = asyncio.get_event_loop()
-        for chunk in data:
-            start_time = loop.time()
-            try:
-                self.writer.write(chunk)
-            except:
-                break
-            await self.writer.drain()
-            self.bytes_sent += len(chunk)
-            sleep_time = delta - loop.time() + start_time
-            if sleep_time > 0:
-                await asyncio.sleep(sleep_time)
+        timeout = self.start_timeout()
+        try:
+            for chunk in data:
+                start_time = loop.time()
+                try:
+                    self.write(chunk)
+                except:
+                    break
+                if release is not None and transport.get_write_buffer_size():
+                    release()
+                await self.writer.drain()
+                timeout.touch()
+                self.bytes_sent += len(chunk)
+                elapsed = loop.time() - start_time
+                sizer.sent(elapsed)
+                if adaptive: data.bufsize = sizer.size
+                sleep_time = len(chunk) / max_down - elapsed if max_down else 0
+                if sleep_time > 0:
+                    await asyncio.sleep(sleep_time)
+            if self.mode == 'b':
+                self.writer.write(BLOCK_HEADER.pack(BLOCK_EOF, 0))
+                await self.writer.drain()
+        except ConnectionError:
+            if not self.timed_out: raise
+        finally:
+            timeout.cancel()
+        if self.timed_out:
+            raise asyncio.TimeoutError
 
-    async def pull(self, fileobj, enc=None):
+    async def pull(self, fileobj, enc=None, reservation=None):
         max_up = self.context.get('max_up')
-        delta = self.config.buf_in / max_up if max_up else 0
+        sizer = self.get_sizer(self.config.buf_in, max_up)
         loop = asyncio.get_event_loop()
-        while True:
-            start_time = loop.time()
-            chunk = await asyncio.wait_for(
-                self.reader.read(self.config.buf_in), self.config.data_timeout)
-            if not chunk: break
-            if enc:
-                chunk = chunk.decode(enc, 'replace')
-            fileobj.write(chunk)
-            self.bytes_received += len(chunk)
-            sleep_time = delta - loop.time() + start_time
-            if sleep_time > 0:
-                await asyncio.sleep(sleep_time)
+        timeout = self.start_timeout()
+        self.eof = False
+        try:
+            while True:
+                start_time = loop.time()
+                chunk = await self.read(sizer.size)
+                if not chunk: break
+                timeout.touch()
+                sizer.received(len(chunk))
+                if reservation is not None:
+                    reservation.charge(len(chunk))
+                if enc:
+                    chunk = chunk.decode(enc, 'replace')
+                fileobj.write(chunk)
+                self.bytes_received += len(chunk)
+                sleep_time = len(chunk) / max_up - loop.time() + start_time if max_up else 0
+                if sleep_time > 0:
+                    await asyncio.sleep(sleep_time)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            if not self.timed_out: raise
+        finally:
+            timeout.cancel()
+        if self.timed_out:
+            raise asyncio.TimeoutError
 
 class PSVTransporter(Transporter):
     def __init__(self, *k, **kw):
         super().__init__(*k, **kw)
-        self.closed = True
+        self.server_closed = True
+
+    def close(self):
+        super().close()
+        asyncio.ensure_future(self.close_server())
 
     async def connect(self, host):
         self.port = await asyncio.wait_for(self.config.get_port(), 1)
-        self.con = await asyncio.start_server(self.onconnect,
-                host=host, port=self.port, backlog=1)
-        self.closed = False
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # Buffer sizes must be set before listening to be inherited by
+            # the accepted socket, the server starts listening on `sock`
+            set_socket_options(sock, self.config.socket_options.get('data', ()))
+            sock.bind((host, self.port))
+            self.con = await asyncio.start_server(self.onconnect, sock=sock, backlog=1)
+        except OSError:
+            sock.close()
+            self.config.put_port(self.port)
+            raise
+        self.server_closed = False
 
     def onconnect(self, reader, writer):
         self.connected.set_result(True)
         self.reader, self.writer = reader, writer
+        set_socket_options(writer.get_extra_info('socket'),
+                self.config.socket_options.get('data', ()))
         asyncio.ensure_future(self.close_server())
 
     async def close_server(self):
-        if not self.closed:
+        if not self.server_closed:
             self.con.close()
-            self.closed = True
+            self.server_closed = True
             await self.con.wait_closed()
             self.config.put_port(self.port)
 
@@ -110,6 +246,8 @@ class PRTTransporter(Transporter):
         self.con = asyncio.open_connection(host=host, port=port)
         reader, writer = await asyncio.wait_for(self.con, 5)
         self.reader, self.writer = reader, writer
+        set_socket_options(writer.get_extra_info('socket'),
+                self.config.socket_options.get('data', ()))
         self.connected.set_result(True)
 
 def get_mlst_handlers():
@@ -164,9 +302,11 @@ class FTPHandler:
         522: 'Network protocol not supported, use (1)',
         530: 'Not logged in.',
         550: 'Requested action not taken.',
+        552: 'Requested file action aborted. Exceeded storage allocation.',
     }
     features = (
         'UTF8',
+        'MODE B',
         'MLST Type*;Size*;Modify*;Perm*;',
     )
     mlst_facts_available = (
@@ -191,8 +331,14 @@ class FTPHandler:
         self.stru = 'f'
         self.ret = None
         self.transporter = None
+        self.timeout = None
+        self.command = None
+        self.status = None
+        self.transferred = 0
         self.remote_addr = writer.get_extra_info('peername')
         self.local_addr = writer.get_extra_info('sockname')
+        set_socket_options(writer.get_extra_info('socket'),
+                config.socket_options.get('control', ()))
         self.set_mlst_facts()
 
     def set_mlst_facts(self, facts=None):
@@ -227,34 +373,77 @@ class FTPHandler:
         context['realpath'] = realpath
         return context
 
-    def list_dir(self, realpath, options={}):
-        '''List directory entries.
+    def list_entries(self, realpath, options={}):
+        '''Return entries of a directory from the index, directories first.'''
+        entries = self.config.get_fsindex().listdir(realpath).values()
+        # Hide entries starting with `.`
+        if not options.get('a'):
+            entries = [entry for entry in entries if not entry.name.startswith('.')]
+        return sorted(entries, key=lambda entry: not is_dir(entry))
+
+    def format_entry(self, entry):
+        '''Format an entry as a line of `LIST`.
 
         Each line looks like this:
 
         -rwxrwxrwx 1 user group 1024 Feb 4 2017 config.py
         '''
-        dirs = {}
-        files = {}
-        opt_a = options.get('a')
-        for name in os.listdir(realpath):
-            # Hide entries starting with `.`
-            if not opt_a and name.startswith('.'):
-                continue
-            item = os.path.join(realpath, name)
+        return '%s %d user group %d %s %s\n' % (
+                stat.filemode(entry.mode), 1,
+                entry.size, time_string(entry.mtime), entry.name)
+
+    def list_dir(self, realpath, options={}):
+        '''List directory entries.'''
+        res = ''.join(map(self.format_entry, self.list_entries(realpath, options)))
+        return res.encode(self.encoding, 'replace')
+
+    def walk(self, path, options={}, perm='l'):
+        '''Yield (path, entries) of `path` and all directories below it
+        with permission `perm`, depth first.'''
+        stack = [path]
+        while stack:
+            context = self.access(stack.pop())
+            if perm not in context['permission']: continue
             try:
-                st = os.stat(item)
-            except:
+                entries = self.list_entries(context['realpath'], options)
+            except OSError:
                 continue
-            line = '%s %d user group %d %s %s\n' % (
-                    stat.filemode(st.st_mode), 1,
-                    st.st_size, time_string(st.st_mtime), name)
-            if os.path.isdir(item):
-                dirs[name] = line
-            else:
-                files[name] = line
-        res = ''.join(line for dic in (dirs, files) for line in dic.values())
-        return res.encode(self.encoding, 'replace')
+            yield context['path'], entries
+            stack.extend(posixpath.join(context['path'], entry.name)
+                    for entry in reversed(entries) if is_dir(entry) and not entry.link)
+
+    def list_tree(self, path, options={}):
+        '''Generate a recursive listing like `ls -lR`.'''
+        for dirpath, entries in self.walk(path, options):
+            relpath = posixpath.relpath(dirpath, path)
+            header = '.:\n' if relpath == '.' else './%s:\n' % relpath
+            res = header + ''.join(map(self.format_entry, entries)) + '\n'
+            yield res.encode(self.encoding, 'replace')
+
+    def name_list(self, path, options={}):
+        '''Generate names of entries in a directory, relative paths of all
+        entries below it if `R` option is set.'''
+        if options.get('r'):
+            tree = self.walk(path, options)
+        else:
+            context = self.access(path)
+            tree = [(path, self.list_entries(context['realpath'], options))]
+        for dirpath, entries in tree:
+            relpath = posixpath.relpath(dirpath, path)
+            prefix = '' if relpath == '.' else relpath + '/'
+            res = ''.join(prefix + entry.name + '\r\n' for entry in entries)
+            yield res.encode(self.encoding, 'replace')
+
+    def parse_options(self, args):
+        '''Split leading options like `-la` from arguments.'''
+        options = {}
+        args = args.strip()
+        while args.startswith('-'):
+            param, _, args = args.partition(' ')
+            args = args.strip()
+            for opt in param[1:].lower():
+                options[opt] = True
+        return options, args
 
     def send_status(self, code, message=None, data=None):
         '''Send status code with a message.
@@ -269,6 +458,7 @@ class FTPHandler:
             for line in data_lines:
                 self.push_status(' ' + line + '\r\n')
         self.push_status('%d %s\r\n' % (code, message))
+        self.status = code
 
     def denied(self, perm, context=None):
         '''Check permission.'''
@@ -305,18 +495,15 @@ class FTPHandler:
     def handle_close(self):
         self.writer.close()
         self.log_message('Connection closed.', '=')
-        self.config.connections[None] -= 1
-        self.config.connections[self.remote_addr[0]] -= 1
+        self.config.close_connection(self.remote_addr[0])
 
     async def handle(self):
         '''A coroutin to handle slow procedures.'''
         ip = self.remote_addr[0]
         config = self.config
-        n = config.connections.get(ip, 0)
-        config.connections[ip] = self.connection_id = n + 1
-        config.connections[None] += 1
+        self.connection_id, total = config.open_connection(ip)
         if (config.max_connection and
-                config.connections[None] > config.max_connection):
+                total > config.max_connection):
             self.send_status(421, '%d users (the maximum) logged in.' % config.max_connection)
             self.handle_close()
             return
@@ -327,19 +514,21 @@ class FTPHandler:
             return
         else:
             self.send_status(220)
+        self.timeout = config.get_timer().add(config.control_timeout, self.on_timeout)
+        tracer = config.get_tracer()
+        if tracer is not None:
+            session = tracer.new_session()
         while True:
-            try:
-                line = await asyncio.wait_for(
-                        self.reader.readline(), config.control_timeout)
-                line = line.strip().decode()
-                cmd, _, args = line.partition(' ')
-            except asyncio.TimeoutError:
-                self.send_status(421, 'Control connection timed out.')
-                self.writer.close()
-                break
+            line = await self.reader.readline()
+            line = line.strip().decode()
+            cmd, _, args = line.partition(' ')
             if not cmd: break
+            self.timeout.touch()
             self.log_message(line)
             cmd = cmd.upper()
+            start = time.monotonic()
+            self.status = None
+            self.transferred = 0
             if self.user is None and cmd not in ('USER', 'PASS', 'QUIT'):
                 self.send_status(530)
                 continue
@@ -347,6 +536,8 @@ class FTPHandler:
             if handle is None:
                 self.send_status(502)
                 continue
+            self.timeout.suspend()
+            self.command = line
             try:
                 ret = handle(args)
                 if asyncio.iscoroutine(ret):
@@ -356,12 +547,29 @@ class FTPHandler:
                 traceback.print_exc()
                 self.ret = None
                 self.send_status(500)
+            self.command = None
+            self.timeout.resume()
+            if tracer is not None:
+                tracer.record(session, start, time.monotonic() - start,
+                        cmd, args, self.transferred, self.status or 0)
+        self.timeout.cancel()
+        self.close_transporter()
+        if tracer is not None:
+            tracer.flush()
         self.handle_close()
 
+    def on_timeout(self):
+        self.send_status(421, 'Control connection timed out.')
+        self.writer.close()
+
     async def handle_transporter(self, callback, *args):
         if self.transporter is None:
             self.send_status(500, 'Data connection must be open first.')
             return
+        elif self.transporter.closed:
+            self.close_transporter()
+            self.send_status(425)
+            return
         elif self.transporter.connected.done():
             self.send_status(125)
         else:
@@ -371,17 +579,33 @@ class FTPHandler:
             except asyncio.TimeoutError:
                 self.send_status(421, 'Data connection time out.')
                 return
+        transporter = self.transporter
+        transporter.mode = self.mode
+        transporter.context = self.context
+        transporter.bytes_sent = transporter.bytes_received = 0
+        # In block mode the data connection is kept open for further transfers
+        keep = False
         try:
             await callback(*args)
         except asyncio.TimeoutError:
             self.send_status(421, 'Data channel time out.')
+        except QuotaExceeded:
+            self.send_status(552)
         except:
             import traceback
             traceback.print_exc()
             self.send_status(426, 'Error occurred.')
         else:
-            self.send_status(226, 'Transfer completed.')
+            keep = self.mode == 'b'
+            self.send_status(250 if keep else 226, 'Transfer completed.')
         finally:
+            self.transferred += transporter.bytes_sent + transporter.bytes_received
+            if not keep:
+                self.close_transporter()
+
+    def close_transporter(self):
+        if self.transporter is not None:
+            self.transporter.close()
             self.transporter = None
 
     async def handle_push_data(self, data):
@@ -390,20 +614,46 @@ class FTPHandler:
         data must be bytes or bytes generator'''
         if isinstance(data, bytes): data = [data]
         await self.transporter.push(data)
-        self.transporter.close()
 
     async def push_data(self, data):
         '''Download from FTP server.'''
         await self.handle_transporter(self.handle_push_data, data)
 
-    async def handle_pull_data(self, fileobj):
+    async def handle_pull_data(self, fileobj, reservation):
         '''Pull data from client.'''
         await self.transporter.pull(fileobj,
-                self.encoding if self.type == 'a' else None)
+                self.encoding if self.type == 'a' else None, reservation)
 
-    async def pull_data(self, fileobj):
+    async def pull_data(self, fileobj, reservation=None):
         '''Upload to FTP server.'''
-        await self.handle_transporter(self.handle_pull_data, fileobj)
+        await self.handle_transporter(self.handle_pull_data, fileobj, reservation)
+
+    def usage_of(self, realpath):
+        '''Return the usage of a path if it is tracked by the usage index.'''
+        if self.config.get_usage().roots_of(realpath):
+            return path_usage(realpath)
+        return 0, 0
+
+    def quota_limits(self, context=None):
+        '''Return the (roots, quota) pairs that apply to `context`.'''
+        if context is None:
+            context = self.context
+        limits = []
+        if context.get('quota'):
+            limits.append(([context['quota_root']], context['quota']))
+        if self.user.quota:
+            limits.append((self.user.roots, self.user.quota))
+        return limits
+
+    def quota_left(self, context=None):
+        '''Return the number of bytes that can still be stored, None for unlimited.
+        Bytes of uploads in progress are already counted.'''
+        usage = self.config.get_usage()
+        with usage.lock:
+            return usage.left(self.quota_limits(context))
+
+    def reserve(self, realpath):
+        return Reservation(self.config.get_usage(), realpath, self.quota_limits())
 
     def ftp_USER(self, args):
         self.username = args.lower()
@@ -450,11 +700,13 @@ class FTPHandler:
 
     def ftp_MODE(self, args):
         mode = args.lower()
-        if mode == 's':
-            self.send_status(200, 'Mode set to S.')
+        if mode in ('s', 'b'):
+            self.send_status(200, 'Mode set to %s.' % mode.upper())
         else:
             self.send_status(504, 'Unsupported mode: %s.' % args)
             return
+        if mode != self.mode:
+            self.close_transporter()
         self.mode = mode
 
     def ftp_TYPE(self, args):
@@ -479,12 +731,16 @@ class FTPHandler:
 
     async def ftp_PASV(self, args):
         '''Passive mode, only support IPv4.'''
-        self.transporter = None
+        self.close_transporter()
         try:
             self.transporter = PSVTransporter(self.config, self.context)
             await self.transporter.connect(self.config.host)
         except asyncio.TimeoutError:
+            self.transporter = None
             self.send_status(500)
+        except OSError:
+            self.transporter = None
+            self.send_status(425)
         else:
             self.send_status(227, 'Entering Passive Mode (%s,%d,%d)' % (
                 self.local_addr[0].replace('.', ','),
@@ -494,7 +750,7 @@ class FTPHandler:
 
     async def ftp_PORT(self, args):
         '''Port mode, only support IPv4.'''
-        self.transporter = None
+        self.close_transporter()
         try:
             args = args.split(',')
             host = '.'.join(args[:4])
@@ -507,20 +763,28 @@ class FTPHandler:
             self.send_status(200)
 
     async def ftp_LIST(self, args):
-        options = {}
-        args = args.strip()
-        while args.startswith('-'):
-            param, _, args = args.partition(' ')
-            args = args.strip()
-            for opt in param[1:].lower():
-                options[opt] = True
+        options, args = self.parse_options(args)
         self.context = self.access(args)
         if self.denied('l'): return
         realpath = self.context['realpath']
         if os.path.isfile(realpath):
             self.send_status(213)
-        elif os.path.isdir(realpath):
+        elif not os.path.isdir(realpath):
+            self.send_status(550, 'Directory not found.')
+        elif options.get('r'):
+            await self.push_data(self.list_tree(self.context['path'], options))
+        else:
             await self.push_data(self.list_dir(realpath, options))
+
+    async def ftp_NLST(self, args):
+        options, args = self.parse_options(args)
+        self.context = self.access(args)
+        if self.denied('l'): return
+        realpath = self.context['realpath']
+        if os.path.isfile(realpath):
+            await self.push_data((args + '\r\n').encode(self.encoding, 'replace'))
+        elif os.path.isdir(realpath):
+            await self.push_data(self.name_list(self.context['path'], options))
         else:
             self.send_status(550, 'Directory not found.')
 
@@ -548,8 +812,40 @@ class FTPHandler:
         if os.path.isfile(realpath):
             await self.push_data(
                     FileProducer(realpath, self.type, self.config.buf_out, self.ret))
-        else:
-            self.send_status(550)
+            return
+        if self.config.archive:
+            for suffix, compress in self.archive_formats:
+                path = self.context['path']
+                if not path.endswith(suffix): continue
+                path = path[:-len(suffix)] or '/'
+                context = self.access(path)
+                if 'r' in context['permission'] and os.path.isdir(context['realpath']):
+                    await self.push_data(TarProducer(self.archive_members(path),
+                        self.config.buf_out, compress))
+                    return
+        self.send_status(550)
+
+    archive_formats = (
+        ('.tar', False),
+        ('.tar.gz', True),
+        ('.tgz', True),
+    )
+    def archive_members(self, path):
+        '''Generate members of an archive of directory `path` for `TarProducer`.'''
+        base = posixpath.basename(path) or 'root'
+        st = os.stat(self.access(path)['realpath'])
+        dirs = {path: Entry(base, st.st_mode, 0, st.st_mtime, False)}
+        for dirpath, entries in self.walk(path, perm='r'):
+            relpath = posixpath.relpath(dirpath, path)
+            arcdir = base if relpath == '.' else posixpath.join(base, relpath)
+            yield arcdir + '/', None, dirs.pop(dirpath)
+            realdir = self.access(dirpath)['realpath']
+            for entry in entries:
+                if is_dir(entry):
+                    dirs[posixpath.join(dirpath, entry.name)] = entry
+                elif stat.S_ISREG(entry.mode):
+                    yield (posixpath.join(arcdir, entry.name),
+                            os.path.join(realdir, entry.name), entry)
 
     def ftp_FEAT(self, args):
         if self.features:
@@ -598,11 +894,29 @@ class FTPHandler:
         else:
             self.context = self.access(args)
             if self.denied('f'): return
+            src, dest = self.ret, self.context['realpath']
+            usage = self.config.get_usage()
+            moved = None
+            if usage.roots_of(src) != usage.roots_of(dest):
+                moved = path_usage(src)
+                left = self.quota_left()
+                if left is not None and moved[0] > left:
+                    self.send_status(552)
+                    return
+            replaced = self.usage_of(dest) if os.path.isfile(dest) else (0, 0)
             try:
-                os.rename(self.ret, self.context['realpath'])
+                os.rename(src, dest)
                 self.send_status(250, 'Renaming ok.')
             except:
                 self.send_status(550)
+                return
+            index = self.config.get_fsindex()
+            index.changed(src)
+            index.changed(dest)
+            usage.update(dest, -replaced[0], -replaced[1])
+            if moved:
+                usage.update(src, -moved[0], -moved[1])
+                usage.update(dest, *moved)
 
     def ftp_MKD(self, args):
         self.context = self.access(args)
@@ -612,6 +926,9 @@ class FTPHandler:
             self.send_status(257, '"%s" directory is created.' % args)
         except:
             self.send_status(550)
+        else:
+            self.config.get_fsindex().changed(self.context['realpath'])
+            self.config.get_usage().update(self.context['realpath'], 0, 1)
 
     def ftp_RMD(self, args):
         self.context = self.access(args)
@@ -626,18 +943,32 @@ class FTPHandler:
                     for item in dirs:
                         remove_dir(os.path.join(root, item))
                 os.rmdir(top)
+            realpath = self.context['realpath']
+            before = self.usage_of(realpath)
             try:
-                remove_dir(self.context['realpath'])
+                remove_dir(realpath)
                 self.send_status(250, 'Directory removed.')
+                after = 0, 0
             except:
                 self.send_status(550)
+                after = self.usage_of(realpath)
+            self.config.get_fsindex().changed(realpath)
+            self.config.get_usage().update(realpath,
+                    after[0] - before[0], after[1] - before[1])
 
     async def ftp_STOR(self, args):
         self.context = self.access(args)
         if self.denied('w'): return
+        realpath = self.context['realpath']
+        old_size, old_count = self.usage_of(realpath)
+        left = self.quota_left()
+        if left is not None and left + old_size <= 0:
+            self.send_status(552)
+            return
         mode = 'r+' if self.ret else 'w'
         if self.type == 'i': mode += 'b'
-        with open(self.context['realpath'], mode) as fileobj:
+        reservation = self.reserve(realpath)
+        with open(realpath, mode) as fileobj:
             if self.ret:
                 try:
                     fileobj.seek(self.ret)
@@ -645,24 +976,58 @@ class FTPHandler:
                     self.send_status(501,
                             'Failed storing data at pos: %s' % self.ret)
             else:
-                await self.pull_data(fileobj)
+                # The file is truncated, its old size is free for the upload
+                self.config.get_usage().update(realpath, -old_size)
+                old_size = 0
+                await self.pull_data(fileobj, reservation)
+        self.config.get_fsindex().changed(realpath)
+        size, count = self.usage_of(realpath)
+        reservation.settle(size - old_size, count - old_count)
 
     async def ftp_APPE(self, args):
         self.context = self.access(args)
         if self.denied('a'): return
+        realpath = self.context['realpath']
+        old_size, old_count = self.usage_of(realpath)
+        left = self.quota_left()
+        if left is not None and left <= 0:
+            self.send_status(552)
+            return
         mode = 'a'
         if self.type == 'i': mode += 'b'
-        with open(self.context['realpath'], mode) as fileobj:
-            await self.pull_data(fileobj)
+        reservation = self.reserve(realpath)
+        with open(realpath, mode) as fileobj:
+            await self.pull_data(fileobj, reservation)
+        self.config.get_fsindex().changed(realpath)
+        size, count = self.usage_of(realpath)
+        reservation.settle(size - old_size, count - old_count)
+
+    def ftp_ALLO(self, args):
+        self.context = self.access()
+        try:
+            size = int(args.split()[0])
+        except (ValueError, IndexError):
+            self.send_status(501)
+            return
+        left = self.quota_left()
+        if left is not None and size > left:
+            self.send_status(552)
+        else:
+            self.send_status(200, 'ALLO command successful.')
 
     def ftp_DELE(self, args):
         self.context = self.access(args)
         if self.denied('d'): return
+        realpath = self.context['realpath']
+        size, count = self.usage_of(realpath)
         try:
-            os.remove(self.context['realpath'])
+            os.remove(realpath)
             self.send_status(250, 'File removed.')
         except:
             self.send_status(550)
+        else:
+            self.config.get_fsindex().changed(realpath)
+            self.config.get_usage().update(realpath, -size, -count)
 
     def ftp_MLST(self, args):
         self.context = self.access(args)
@@ -695,3 +1060,85 @@ class FTPHandler:
             data.append(info)
         data = '\n'.join(data).encode(self.encoding)
         await self.push_data(data)
+
+    def ftp_SITE(self, args):
+        cmd, _, args = args.strip().partition(' ')
+        handle = getattr(self, 'site_' + cmd.upper(), None)
+        if handle is None:
+            self.send_status(504, 'Unknown SITE command: %s.' % cmd)
+            return
+        return handle(args.strip())
+
+    def site_PROFILE(self, args):
+        if not self.user.admin:
+            self.send_status(550, 'Permission denied.')
+            return
+        try:
+            duration = int(args) if args else self.config.profile_duration
+        except ValueError:
+            self.send_status(501)
+            return
+        if duration <= 0:
+            self.send_status(501, 'Duration must be a positive number of seconds.')
+            return
+        duration = min(duration, self.config.profile_max_duration)
+        filename = self.config.get_profiler().start(duration)
+        if filename is None:
+            self.send_status(550, 'Profiler is already running.')
+        else:
+            self.send_status(200, 'Profiling for %ds, report will be written to %s.' % (duration, filename))
+
+    def site_QUOTA(self, args):
+        context = self.access(args)
+        usage = self.config.get_usage()
+        lines = []
+        if self.user.quota:
+            used = sum(usage.get(root)[0] for root in self.user.roots)
+            lines.append('User %s: %d of %d bytes used.' % (self.user.name, used, self.user.quota))
+        if context.get('quota'):
+            used, count = usage.get(context['quota_root'])
+            lines.append('Directory %s: %d of %d bytes used in %d entries.' % (
+                context['path'], used, context['quota'], count))
+        if lines:
+            self.send_status(211, 'End', ('Quota:', lines))
+        else:
+            self.send_status(211, 'No quota.')
+
+    async def site_FIND(self, args):
+        '''SITE FIND [path] [name=PATTERN] [type=f|d] [newer=TIME] [older=TIME]
+
+        TIME is in the format of YYYYMMDDHHMMSS.'''
+        path = []
+        filters = {}
+        for arg in args.split(' '):
+            key, sep, value = arg.partition('=')
+            if sep and key.lower() in ('name', 'type', 'newer', 'older'):
+                filters[key.lower()] = value
+            else:
+                path.append(arg)
+        try:
+            for key in ('newer', 'older'):
+                if key in filters:
+                    filters[key] = parse_time(filters[key])
+        except ValueError:
+            self.send_status(501, 'Time must be in the format of YYYYMMDDHHMMSS.')
+            return
+        self.context = self.access(' '.join(path).strip())
+        if self.denied('l'): return
+        if not os.path.isdir(self.context['realpath']):
+            self.send_status(550, 'Directory not found.')
+            return
+        await self.push_data(self.find(self.context['path'], **filters))
+
+    def find(self, path, name=None, type=None, newer=None, older=None):
+        '''Generate paths of entries below `path` matching the filters.'''
+        for dirpath, entries in self.walk(path):
+            res = []
+            for entry in entries:
+                if name and not fnmatch.fnmatchcase(entry.name, name): continue
+                if type and type != ('d' if is_dir(entry) else 'f'): continue
+                if newer is not None and entry.mtime <= newer: continue
+                if older is not None and entry.mtime >= older: continue
+                res.append(posixpath.join(dirpath, entry.name) + '\r\n')
+            if res:
+                yield ''.join(res).encode(self.encoding, 'replace')
@@ -0,0 +1,108 @@
+'''
+Runtime diagnostics: event loop lag monitor and on-demand profiler.
+'''
+import asyncio, threading, traceback, time, sys, os
+import cProfile, pstats, io
+from .log import logger
+
+class LagMonitor:
+    '''Detect callbacks that block the event loop.
+
+    The loop bumps a heartbeat every `interval` seconds. A watchdog thread
+    checks the heartbeat and, when the loop has been stuck for more than
+    `threshold` seconds, logs the stack of the loop thread together with
+    the FTP command that was being handled.
+    '''
+    def __init__(self, threshold=0.1, interval=None, loop=None):
+        self.threshold = threshold
+        self.interval = interval or threshold / 2
+        self.loop = loop
+        self.beat = None
+        self.reported = None
+        self.handle = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        self.thread_id = threading.get_ident()
+        self.beat = time.monotonic()
+        self.handle = self.loop.call_later(self.interval, self.heartbeat)
+        self.thread = threading.Thread(target=self.watch, name='slftpd-lag-monitor', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def heartbeat(self):
+        now = time.monotonic()
+        lag = now - self.beat - self.interval
+        if lag > self.threshold:
+            logger.warning('Event loop blocked for %.3fs', lag)
+        self.beat = now
+        self.handle = self.loop.call_later(self.interval, self.heartbeat)
+
+    def watch(self):
+        while not self.stopped.wait(self.interval):
+            beat = self.beat
+            if beat == self.reported: continue
+            if time.monotonic() - beat - self.interval > self.threshold:
+                self.reported = beat
+                self.report()
+
+    def report(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None: return
+        stack = ''.join(traceback.format_stack(frame))
+        logger.warning('Slow callback detected while handling %s:\n%s',
+                find_command(frame) or 'no command', stack)
+
+def find_command(frame):
+    '''Find the FTP command being handled in the frames of a stack.'''
+    while frame is not None:
+        handler = frame.f_locals.get('self')
+        command = getattr(handler, 'command', None)
+        if command is not None and hasattr(handler, 'remote_addr'):
+            return '%r from %s' % (command, handler.remote_addr[0])
+        frame = frame.f_back
+
+class Profiler:
+    '''Time-boxed cProfile run of the event loop thread.'''
+    def __init__(self, directory='.'):
+        self.directory = directory
+        self.profile = None
+        self.filename = None
+
+    @property
+    def running(self):
+        return self.profile is not None
+
+    def start(self, duration, loop=None):
+        '''Start profiling, return the path of the report to be written.'''
+        if self.running:
+            return
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.filename = os.path.join(self.directory,
+                time.strftime('slftpd-profile-%Y%m%d-%H%M%S'))
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        loop.call_later(duration, self.stop)
+        logger.info('Profiling for %ds', duration)
+        return self.filename + '.txt'
+
+    def stop(self):
+        profile, self.profile = self.profile, None
+        if profile is None: return
+        profile.disable()
+        profile.dump_stats(self.filename + '.prof')
+        output = io.StringIO()
+        stats = pstats.Stats(profile, stream=output)
+        stats.sort_stats('cumulative').print_stats(50)
+        with open(self.filename + '.txt', 'w') as fp:
+            fp.write(output.getvalue())
+        logger.info('Profile written to %s.txt', self.filename)
@@ -0,0 +1,190 @@
+'''
+Incremental disk usage index for storage quotas.
+
+Usage of each tracked root directory is computed once (or loaded from a
+snapshot) and then updated by the commands that change the file tree, so
+quota checks never have to walk the tree.
+'''
+import os, json, asyncio, atexit, threading
+from .log import logger
+
+class QuotaExceeded(Exception):
+    pass
+
+def _normpath(path):
+    return os.path.abspath(path).replace('\\', '/')
+
+def scan(top):
+    '''Return the total size and number of entries below `top`.'''
+    size = count = 0
+    stack = [top]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                count += 1
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        size += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+    return size, count
+
+def path_usage(path):
+    '''Return the usage of a single file or directory, including itself.'''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return 0, 0
+    if os.path.isdir(path):
+        size, count = scan(path)
+        return size, count + 1
+    return st.st_size, 1
+
+class UsageIndex:
+    '''Size and entry count of the root directories that have quotas.
+
+    - roots {Dict} real root path => [size, count]
+    '''
+    def __init__(self, snapshot=None):
+        self.snapshot = snapshot
+        self.roots = {}
+        self.lock = threading.Lock()
+
+    def track(self, root):
+        root = _normpath(root)
+        self.roots.setdefault(root, None)
+        return root
+
+    def roots_of(self, path):
+        path = _normpath(path)
+        return [root for root in self.roots
+                if path == root or path.startswith(root + '/')]
+
+    def update(self, path, size=0, count=0):
+        '''Record a change of `size` bytes and `count` entries at `path`.'''
+        for root in self.roots_of(path):
+            usage = self.roots[root]
+            if usage is not None:
+                with self.lock:
+                    usage[0] += size
+                    usage[1] += count
+
+    def get(self, root):
+        usage = self.roots.get(_normpath(root))
+        return tuple(usage) if usage else (0, 0)
+
+    def left(self, limits):
+        '''Return the bytes left within `limits`, None for unlimited.
+
+        - limits MUST be a list of (roots, quota), where quota is the number
+          of bytes that can be stored in all of the roots together.
+        '''
+        left = None
+        for roots, quota in limits:
+            used = sum(self.get(root)[0] for root in roots)
+            left = quota - used if left is None else min(left, quota - used)
+        return left
+
+    def charge(self, path, size, limits):
+        '''Add `size` bytes at `path` if they fit in `limits`, return whether
+        they are added. The check and the update are atomic, so concurrent
+        uploads cannot exceed a quota together.'''
+        with self.lock:
+            left = self.left(limits)
+            if left is not None and size > left:
+                return False
+            for root in self.roots_of(path):
+                usage = self.roots[root]
+                if usage is not None:
+                    usage[0] += size
+            return True
+
+    def build(self, config):
+        '''Track all roots with quotas in config and compute their usage.'''
+        for user in config.users.values():
+            if user.quota:
+                for root in user.roots:
+                    self.track(root)
+            for rule in user.rules:
+                if dict(rule.attrs).get('quota'):
+                    self.track(rule.dest)
+        if not self.roots: return
+        self.load()
+        for root, usage in self.roots.items():
+            if usage is None:
+                self.roots[root] = list(scan(root))
+                logger.info('Disk usage of %s: %d bytes in %d entries', root, *self.roots[root])
+        if self.snapshot:
+            self.save()
+            atexit.register(self.save)
+
+    def load(self):
+        if not self.snapshot or not os.path.isfile(self.snapshot): return
+        try:
+            with open(self.snapshot) as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            logger.warning('Invalid usage snapshot: %s', self.snapshot)
+            return
+        for root in self.roots:
+            if root in data:
+                self.roots[root] = list(data[root])
+
+    def save(self):
+        tmp = self.snapshot + '.tmp'
+        with self.lock:
+            data = json.dumps(self.roots)
+        with open(tmp, 'w') as fp:
+            fp.write(data)
+        os.replace(tmp, self.snapshot)
+
+    async def reconcile(self):
+        '''Rescan all roots to pick up changes made outside the server.
+
+        Changes made by FTP commands while a root is being scanned may be
+        counted twice or not at all until the next reconciliation.
+        '''
+        loop = asyncio.get_event_loop()
+        for root in list(self.roots):
+            usage = await loop.run_in_executor(None, scan, root)
+            if list(usage) != self.roots[root]:
+                logger.info('Disk usage of %s reconciled: %d bytes in %d entries', root, *usage)
+            self.roots[root] = list(usage)
+        if self.snapshot:
+            self.save()
+
+    def schedule_reconcile(self, interval, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        def run():
+            task = asyncio.ensure_future(self.reconcile())
+            task.add_done_callback(lambda _: loop.call_later(interval, run))
+        loop.call_later(interval, run)
+
+class Reservation:
+    '''Space taken in a `UsageIndex` by a file while it is being stored.
+
+    Each chunk is charged before it is written, the charged bytes are
+    replaced by the real change of the file when the upload ends.
+    '''
+    def __init__(self, index, path, limits):
+        self.index = index
+        self.path = path
+        self.limits = limits
+        self.size = 0
+
+    def charge(self, size):
+        if not self.index.charge(self.path, size, self.limits):
+            raise QuotaExceeded
+        self.size += size
+
+    def settle(self, size, count):
+        '''Record the real change of `size` bytes and `count` entries.'''
+        self.index.update(self.path, size - self.size, count)
+        self.size = 0
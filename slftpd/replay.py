@@ -0,0 +1,162 @@
+'''
+Replay a session trace against a local server.
+
+Usage:
+
+    python3 -m slftpd.replay trace.bin --speed 10
+
+A stand-in file tree is generated from the trace so that downloads return
+the recorded number of bytes, then each recorded session is replayed with
+its original timing scaled by `--speed` (0 for as fast as possible).
+'''
+import asyncio, argparse, logging, posixpath, tempfile, os, shutil
+from collections import OrderedDict, defaultdict
+from .client import FTPClient, FTPError
+from .server import start_local_server
+from .trace import read_trace
+from .log import logger
+
+def load_sessions(filename):
+    sessions = OrderedDict()
+    for record in read_trace(filename):
+        sessions.setdefault(record.session, []).append(record)
+    return sessions
+
+def strip_options(args):
+    args = args.strip()
+    while args.startswith('-'):
+        args = args.partition(' ')[2].strip()
+    return args
+
+def build_tree(sessions, root):
+    '''Create the files and directories that commands in the trace touched.'''
+    def realpath(path):
+        return os.path.join(root, path.lstrip('/'))
+    def make_dir(path):
+        os.makedirs(realpath(path), exist_ok=True)
+    def make_file(path, size=0):
+        make_dir(posixpath.dirname(path))
+        fullpath = realpath(path)
+        if os.path.isdir(fullpath): return
+        with open(fullpath, 'ab') as fp:
+            if fp.tell() < size:
+                fp.truncate(size)
+    for records in sessions.values():
+        cwd = '/'
+        for record in records:
+            if record.code >= 400: continue
+            cmd = record.cmd
+            path = posixpath.normpath(posixpath.join(cwd, strip_options(record.args)))
+            if cmd == 'CWD':
+                make_dir(path)
+                cwd = path
+            elif cmd == 'CDUP':
+                cwd = posixpath.dirname(cwd)
+            elif cmd in ('LIST', 'NLST', 'MLSD', 'RMD'):
+                make_dir(path)
+            elif cmd == 'RETR':
+                make_file(path, record.size)
+            elif cmd in ('SIZE', 'MDTM', 'DELE', 'RNFR', 'MLST'):
+                if not os.path.exists(realpath(path)):
+                    make_file(path)
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.bytes = 0
+        self.errors = 0
+        self.mismatches = 0
+
+    def report(self, elapsed):
+        count = sum(len(values) for values in self.latencies.values())
+        print('Replayed %d commands in %.2fs: %.1f commands/s, %.2f MB/s' % (
+            count, elapsed, count / elapsed, self.bytes / elapsed / 0x100000))
+        print('Session errors: %d, unexpected replies: %d' % (self.errors, self.mismatches))
+        print('%-8s %8s %9s %9s %9s %9s' % ('Command', 'Count', 'p50(ms)', 'p90(ms)', 'p99(ms)', 'max(ms)'))
+        for cmd, values in sorted(self.latencies.items()):
+            values.sort()
+            print('%-8s %8d %9.2f %9.2f %9.2f %9.2f' % ((cmd, len(values)) + tuple(
+                percentile(values, p) * 1000 for p in (50, 90, 99, 100))))
+
+def percentile(values, p):
+    '''Nearest-rank percentile of sorted values.'''
+    index = max(0, -(-len(values) * p // 100) - 1)
+    return values[int(index)]
+
+async def replay_session(records, addr, speed, start, stats, semaphore):
+    loop = asyncio.get_event_loop()
+    client = None
+    async with semaphore:
+        try:
+            for record in records:
+                if speed:
+                    delay = start + record.offset / speed - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                if client is None:
+                    client = FTPClient()
+                    await client.connect(*addr)
+                cmd = record.cmd
+                if cmd == 'USER':
+                    line = 'USER anonymous'
+                elif cmd == 'PASS':
+                    line = 'PASS '
+                elif cmd in ('PASV', 'EPSV', 'PORT', 'EPRT'):
+                    line = 'PASV'
+                else:
+                    line = cmd + (' ' + record.args if record.args else '')
+                time_start = loop.time()
+                size = 0
+                if line == 'PASV':
+                    code, _ = await client.pasv()
+                else:
+                    code, _, size = await client.transfer(line, record.size)
+                stats.latencies[cmd].append(loop.time() - time_start)
+                stats.bytes += size
+                if record.code and code // 100 != record.code // 100:
+                    stats.mismatches += 1
+                if cmd == 'QUIT': break
+        except (FTPError, OSError):
+            stats.errors += 1
+        finally:
+            if client is not None:
+                client.close()
+
+async def replay(sessions, addr, speed, concurrency):
+    loop = asyncio.get_event_loop()
+    stats = Stats()
+    semaphore = asyncio.Semaphore(concurrency)
+    start = loop.time()
+    await asyncio.gather(*(replay_session(records, addr, speed, start, stats, semaphore)
+        for records in sessions.values()))
+    return stats, loop.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a trace recorded by slftpd.')
+    parser.add_argument('trace', help='the trace file recorded with --trace')
+    parser.add_argument('-s', '--speed', type=float, default=1,
+            help='speed factor of the replay, 0 for as fast as possible')
+    parser.add_argument('-c', '--concurrency', type=int, default=100,
+            help='maximum number of sessions replayed at the same time')
+    parser.add_argument('-d', '--root', help='directory to build the stand-in file tree in')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.WARNING)
+    sessions = load_sessions(args.trace)
+    root = args.root or tempfile.mkdtemp(prefix='slftpd-replay-')
+    try:
+        build_tree(sessions, root)
+        addr = start_local_server(root)
+        loop = asyncio.new_event_loop()
+        stats, elapsed = loop.run_until_complete(
+                replay(sessions, addr, args.speed, args.concurrency))
+        print('Trace: %s, %d sessions, speed: %s' % (
+            args.trace, len(sessions), args.speed or 'max'))
+        stats.report(elapsed)
+    finally:
+        if not args.root:
+            shutil.rmtree(root, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
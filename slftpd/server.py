@@ -1,7 +1,27 @@
-import asyncio
+import asyncio, signal, socket, threading
 from . import ftpd
+from .config import Config
+from .monitor import LagMonitor
 from .log import logger
 
+def new_event_loop(backend='asyncio'):
+    '''Create an event loop of `backend`, which may be one of:
+
+    - asyncio: the default loop of the standard library.
+    - uvloop: requires the uvloop package.
+    - auto: uvloop if it is installed, otherwise asyncio.
+    '''
+    if backend in ('uvloop', 'auto'):
+        try:
+            import uvloop
+        except ImportError:
+            if backend == 'uvloop': raise
+        else:
+            return uvloop.new_event_loop()
+    elif backend != 'asyncio':
+        raise ValueError('Unknown event loop backend: %s' % backend)
+    return asyncio.new_event_loop()
+
 class FTPServer:
     def __init__(self, config):
         self.config = config
@@ -10,15 +30,76 @@ class FTPServer:
         handler = ftpd.FTPHandler(self.config, reader, writer)
         await handler.handle()
 
-    async def serve(self):
-        loop = asyncio.get_event_loop()
-        self.server = await asyncio.start_server(self.handle, self.config.host, self.config.port)
+    async def serve(self, port=None, reuse_port=False):
+        '''Start listening, with `reuse_port` several loops may listen on
+        the same port and connections are balanced by the kernel.'''
+        if port is None:
+            port = self.config.port
+        kw = {'reuse_port': True} if reuse_port else {}
+        self.server = await asyncio.start_server(self.handle, self.config.host, port, **kw)
         self.sockets = self.server.sockets
 
+def start_in_thread(config, port=None, reuse_port=False):
+    '''Run a server on a new event loop in a daemon thread.'''
+    loop = new_event_loop(config.loop)
+    def run():
+        asyncio.set_event_loop(loop)
+        if config.lag_threshold:
+            LagMonitor(config.lag_threshold, loop=loop).start()
+        loop.run_forever()
+    threading.Thread(target=run, name='slftpd-loop', daemon=True).start()
+    server = FTPServer(config)
+    asyncio.run_coroutine_threadsafe(server.serve(port, reuse_port), loop).result()
+    return server
+
+def get_threads(config):
+    threads = max(1, config.threads)
+    if threads > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        logger.warning('SO_REUSEPORT is not supported, using only one thread')
+        threads = 1
+    return threads
+
 def serve(config):
-    loop = asyncio.get_event_loop()
+    threads = get_threads(config)
+    loop = new_event_loop(config.loop)
+    asyncio.set_event_loop(loop)
     server = FTPServer(config)
-    loop.run_until_complete(server.serve())
+    usage = config.get_usage()
+    usage.build(config)
+    if usage.roots and config.quota_reconcile:
+        usage.schedule_reconcile(config.quota_reconcile, loop)
+    # Open the trace before serving so that an invalid file fails at startup
+    config.get_tracer()
+    loop.run_until_complete(server.serve(reuse_port=threads > 1))
     for sock in server.sockets:
         logger.info('Serving on %s, port %d', *sock.getsockname()[:2])
+    port = server.sockets[0].getsockname()[1]
+    for _ in range(threads - 1):
+        start_in_thread(config, port, True)
+    logger.info('Using %s event loop in %d thread(s)', type(loop).__module__, threads)
+    if config.lag_threshold:
+        LagMonitor(config.lag_threshold, loop=loop).start()
+    if hasattr(signal, 'SIGUSR1'):
+        loop.add_signal_handler(signal.SIGUSR1,
+                config.get_profiler().start, config.profile_duration, loop)
     loop.run_forever()
+
+def start_local_server(root, ports=(20000, 21000), backend='asyncio', threads=1):
+    '''Run a server with full permissions on `root` in separate threads,
+    return its address. Used by the replay tool and benchmarks.'''
+    config = Config()
+    config.host = '127.0.0.1'
+    config.port = 0
+    config.max_connection = 0
+    config.loop = backend
+    config.threads = threads
+    config.set_ports(*ports)
+    config.add_anonymous_user(homedir=root, attrs=(
+        ('permission', 'elrwadfm'),
+    ))
+    threads = get_threads(config)
+    server = start_in_thread(config, reuse_port=threads > 1)
+    addr = server.sockets[0].getsockname()[:2]
+    for _ in range(threads - 1):
+        start_in_thread(config, addr[1], True)
+    return addr
@@ -0,0 +1,104 @@
+'''
+Hashed timer wheel for idle timeouts.
+
+Touching a timeout only stores the current tick, the wheel sweeps one slot
+per tick and either fires expired entries or moves them to the slot of their
+new deadline.
+'''
+import asyncio
+from .log import logger
+
+class Timeout:
+    '''An idle timeout tracked by a `TimerWheel`.'''
+    def __init__(self, wheel, timeout, callback):
+        self.wheel = wheel
+        self.timeout = timeout
+        self.callback = callback
+        self.last_active = wheel.now
+        self.suspended = False
+        self.slot = None
+
+    def touch(self):
+        '''Mark the connection as active.'''
+        self.last_active = self.wheel.now
+
+    def suspend(self):
+        '''Stop counting idle time until `resume` is called.'''
+        self.suspended = True
+
+    def resume(self):
+        self.suspended = False
+        self.last_active = self.wheel.now
+
+    def cancel(self):
+        self.wheel.remove(self)
+
+class TimerWheel:
+    def __init__(self, resolution=1, slots=512, loop=None):
+        self.resolution = resolution
+        self.slots = [set() for _ in range(slots)]
+        self.loop = loop
+        self.ticks = 0
+        self.now = 0
+        self.count = 0
+        self.handle = None
+
+    def add(self, timeout, callback):
+        '''Track a new timeout, `callback` is called without arguments once
+        the entry has been idle for `timeout` seconds.'''
+        if self.handle is None:
+            self.start()
+        entry = Timeout(self, timeout, callback)
+        self.schedule(entry, timeout)
+        self.count += 1
+        return entry
+
+    def remove(self, entry):
+        if entry.slot is not None:
+            entry.slot.discard(entry)
+            entry.slot = None
+            self.count -= 1
+
+    def schedule(self, entry, delay):
+        ticks = max(1, int(-(-delay // self.resolution)))
+        slot = self.slots[(self.ticks + ticks) % len(self.slots)]
+        slot.add(entry)
+        entry.slot = slot
+
+    def start(self):
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        self.now = self.loop.time()
+        self.handle = self.loop.call_later(self.resolution, self.sweep)
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def sweep(self):
+        self.ticks += 1
+        self.now = self.loop.time()
+        slot = self.slots[self.ticks % len(self.slots)]
+        expired = []
+        for entry in list(slot):
+            slot.discard(entry)
+            if entry.suspended:
+                self.schedule(entry, entry.timeout)
+                continue
+            remaining = entry.last_active + entry.timeout - self.now
+            if remaining > 0:
+                self.schedule(entry, remaining)
+            else:
+                entry.slot = None
+                self.count -= 1
+                expired.append(entry)
+        for entry in expired:
+            try:
+                entry.callback()
+            except:
+                logger.exception('Error in timeout callback')
+        if self.count:
+            self.handle = self.loop.call_later(self.resolution, self.sweep)
+        else:
+            self.handle = None
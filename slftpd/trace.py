@@ -0,0 +1,97 @@
+'''
+Compact binary trace of FTP sessions.
+
+A trace starts with `MAGIC` followed by records, each record is packed as
+`RECORD` (start offset in seconds, session id, duration in seconds, bytes
+transferred, reply code) followed by the command and its arguments, both
+prefixed by their length.
+
+Restarting the server with the same trace file appends to it, the offsets
+and session ids of a new run continue from the last record.
+'''
+import struct, hashlib, itertools, time, os, atexit
+from collections import namedtuple
+
+MAGIC = b'SLFTRC\x01\n'
+RECORD = struct.Struct('<dIfQH')
+STR8 = struct.Struct('<B')
+STR16 = struct.Struct('<H')
+
+Record = namedtuple('Record', 'offset session duration size code cmd args')
+
+class TraceWriter:
+    '''Append session records to a trace file.
+
+    User names are replaced by salted hashes and passwords are dropped, the
+    salt is random for each run so names can't be recovered.
+    '''
+    def __init__(self, filename):
+        self.fp = open(filename, 'ab')
+        self.salt = os.urandom(16)
+        self.start = time.monotonic()
+        last_session = 0
+        if self.fp.tell():
+            end = len(MAGIC)
+            with open(filename, 'rb') as fp:
+                for record, end in iter_records(fp):
+                    self.start = min(self.start, time.monotonic() - record.offset)
+                    last_session = max(last_session, record.session)
+            # Drop a record left incomplete by the last run
+            self.fp.truncate(end)
+        else:
+            self.fp.write(MAGIC)
+        self.sessions = itertools.count(last_session + 1)
+        atexit.register(self.close)
+
+    def new_session(self):
+        return next(self.sessions)
+
+    def anonymize(self, cmd, args):
+        if cmd == 'USER':
+            return 'user-' + hashlib.sha256(self.salt + args.encode()).hexdigest()[:10]
+        if cmd in ('PASS', 'ACCT'):
+            return ''
+        return args
+
+    def record(self, session, start, duration, cmd, args, size=0, code=0):
+        '''Record a command started at `start` (from `time.monotonic`).'''
+        cmd = cmd.encode()[:0xff]
+        args = self.anonymize(cmd.decode(), args).encode()[:0xffff]
+        self.fp.write(RECORD.pack(start - self.start, session, duration, size, code)
+                + STR8.pack(len(cmd)) + cmd + STR16.pack(len(args)) + args)
+
+    def flush(self):
+        if not self.fp.closed:
+            self.fp.flush()
+
+    def close(self):
+        if not self.fp.closed:
+            self.fp.close()
+
+def read_string(fp, prefix):
+    head = fp.read(prefix.size)
+    if len(head) < prefix.size: return
+    length, = prefix.unpack(head)
+    data = fp.read(length)
+    if len(data) == length:
+        return data.decode('utf-8', 'replace')
+
+def iter_records(fp):
+    '''Yield (record, end position) of each complete record in a trace.'''
+    if fp.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a trace file: %s' % fp.name)
+    while True:
+        head = fp.read(RECORD.size)
+        if len(head) < RECORD.size: break
+        offset, session, duration, size, code = RECORD.unpack(head)
+        cmd = read_string(fp, STR8)
+        if cmd is None: break
+        args = read_string(fp, STR16)
+        if args is None: break
+        yield Record(offset, session, duration, size, code, cmd, args), fp.tell()
+
+def read_trace(filename):
+    '''Yield records of a trace file.'''
+    with open(filename, 'rb') as fp:
+        for record, _ in iter_records(fp):
+            yield record
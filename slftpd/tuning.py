@@ -0,0 +1,47 @@
+'''
+Per-transfer chunk sizing and socket options.
+'''
+from .log import logger
+
+class ChunkSizer:
+    '''Adapt the chunk size of a transfer to its throughput.
+
+    The size doubles while chunks are handled without waiting and halves
+    when a chunk takes longer than `target` seconds to drain, so that each
+    chunk holds roughly `target` seconds of data. With a rate limit the
+    size is fixed to `target` seconds at that rate to keep throttling smooth.
+    '''
+    def __init__(self, minimum, maximum, rate=0, target=0.02):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.rate = rate
+        self.target = target
+        self.size = self.clamp(rate * target if rate else minimum)
+
+    def clamp(self, size):
+        return max(self.minimum, min(self.maximum, int(size)))
+
+    def sent(self, elapsed):
+        '''Update after a chunk took `elapsed` seconds to be written and drained.'''
+        if self.rate: return
+        if elapsed < self.target / 4:
+            self.size = min(self.maximum, self.size * 2)
+        elif elapsed > self.target:
+            self.size = max(self.minimum, self.size // 2)
+
+    def received(self, length):
+        '''Update after a read of at most `size` bytes returned `length` bytes.'''
+        if self.rate: return
+        if length >= self.size:
+            self.size = min(self.maximum, self.size * 2)
+        elif length < self.size // 4:
+            self.size = max(self.minimum, self.size // 2)
+
+def set_socket_options(sock, options):
+    '''Apply options composed of (level, option, value) to a socket.'''
+    if sock is None: return
+    for level, option, value in options:
+        try:
+            sock.setsockopt(level, option, value)
+        except OSError as e:
+            logger.warning('Failed setting socket option %s: %s', option, e)